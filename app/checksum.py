@@ -0,0 +1,19 @@
+"""
+Request parameters checksum
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2020
+"""
+from hashlib import sha1
+from os import environ
+
+def computeChecksum(**kwargs):
+    """ Compute checksum for parameters
+    """
+    concat = ""
+    for key in sorted(kwargs):
+        concat += key
+        value = kwargs[key]
+        if value is not None:
+            concat += str(kwargs[key])
+    concat += environ.get('APP_SECRET')
+    return sha1(concat.encode()).hexdigest()
@@ -4,12 +4,30 @@ SQLAlchemy database setup module
 @author: Jad Haddad <jad.haddad92@gmail.com> 2020
 """
 import os
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
+from time import monotonic
+from typing import Optional
+from uuid import UUID
+from zlib import crc32
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = os.environ['DATABASE_URL']
+# extra shards, the primary database (DATABASE_URL) is always shard 0
+SHARDS_URLS = [SQLALCHEMY_DATABASE_URL] + \
+              [uri for uri in os.environ.get('DATABASE_SHARDS', '').split(',') if uri]
+# seconds during which a worker trusts its copy of the app -> shard directory
+SHARD_MAP_TTL = float(os.environ.get('SHARD_MAP_TTL', 5))
+# connections a shard accepts from the web workers (Postgres' max_connections is 100
+# by default, the rest is left to migrations and maintenance), split between them
+MAX_CONNECTIONS = int(os.environ.get('DATABASE_MAX_CONNECTIONS', 80))
+WORKERS = int(os.environ.get('WEB_CONCURRENCY', 4))
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+POOL_MAX_OVERFLOW = int(os.environ.get('DATABASE_POOL_MAX_OVERFLOW',
+                                       max(0, MAX_CONNECTIONS // WORKERS - POOL_SIZE)))
+# seconds a request waits for a pooled connection before failing
+POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
 
 # class Singleton(type):
 #     """ singleton pattern
@@ -23,14 +41,70 @@ SQLALCHEMY_DATABASE_URL = os.environ['DATABASE_URL']
 #             cls._instance = super().__call__(*args, **kwargs)
 #         return cls._instance
 
+_engines = {}
+_placements = {}
+
+def getEngine(uri: str):
+    """ get the engine (and its connection pool) shared by the process for `uri`
+    """
+    engine = _engines.get(uri)
+    if engine is None:
+        engine = create_engine(uri, pool_timeout=POOL_TIMEOUT, pool_size=POOL_SIZE,
+                               max_overflow=POOL_MAX_OVERFLOW, executemany_mode='batch')
+        engine = _engines.setdefault(uri, engine)
+    return engine
+
+def normalizeAppId(appId: str):
+    """ canonical form of an app id, so that hex and dashed UUIDs hash the same
+    """
+    try:
+        return UUID(appId).hex
+    except ValueError:
+        return appId
+
+def hashShard(appId: str, shardsCount: int):
+    """ default shard of an app when it is not pinned in the directory
+    """
+    return crc32(normalizeAppId(appId).encode()) % shardsCount
+
+def getPlacements(uri: str):
+    """ app -> (shard, frozen) directory stored in 'app_shards' on the primary database,
+        reloaded at most every SHARD_MAP_TTL seconds
+    """
+    loadedAt, placements = _placements.get(uri, (None, None))
+    now = monotonic()
+    if loadedAt is None or now - loadedAt > SHARD_MAP_TTL:
+        with getEngine(uri).connect() as connection:
+            rows = connection.execute(text("SELECT app_id, shard, frozen "
+                                           "FROM app_shards"))
+            placements = {UUID(str(appId)).hex: (shard, frozen)
+                          for (appId, shard, frozen) in rows}
+        _placements[uri] = (now, placements)
+    return placements
+
 
 class Database():
-    """ main database object
+    """ main database object, routed to the shard holding `appId`
     """
-    def __init__(self, uri: str=SQLALCHEMY_DATABASE_URL):
-        """ connect to SQLAlchemy database
+    shards = SHARDS_URLS
+    
+    def __init__(self, appId: Optional[str]=None):
+        """ connect to the SQLAlchemy database of `appId` (primary database if None)
+        """
+        self.appId = appId
+        self.shard, self.frozen = self.locate(appId)
+        self.engine = getEngine(self.shards[self.shard])
+    
+    @classmethod
+    def locate(cls, appId: Optional[str]):
+        """ shard index of `appId` and whether it is frozen by a rebalancing
         """
-        self.engine = create_engine(uri, pool_timeout=0)
+        if appId is None or len(cls.shards) == 1:
+            return 0, False
+        placement = getPlacements(cls.shards[0]).get(normalizeAppId(appId))
+        if placement is not None:
+            return placement
+        return hashShard(appId, len(cls.shards)), False
     
     # pylint: disable=no-member
     @contextmanager
@@ -46,3 +120,22 @@ class Database():
             raise
         finally:
             session.close()
+    
+    @contextmanager
+    def broadcast(self):
+        """ execute a SQL transaction on every shard, used for replicated tables
+            (users, apps); sessions are yielded primary first
+        """
+        with ExitStack() as stack:
+            yield [stack.enter_context(self.onShard(shard).transaction())
+                   for shard in range(len(self.shards))]
+    
+    @classmethod
+    def onShard(cls, shard: int, appId: Optional[str]=None):
+        """ database object bound to a given shard, regardless of where `appId` is placed
+        """
+        database = cls()
+        database.appId = appId
+        database.shard = shard
+        database.engine = getEngine(cls.shards[shard])
+        return database
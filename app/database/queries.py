@@ -0,0 +1,85 @@
+"""
+Hot queries, built once
+
+ORM lookups are baked: the Query object and its compiled SQL are cached after
+the first call. Aggregates and joins are server-side prepared statements, parsed
+once per pooled connection, with planning cached once Postgres picks a generic plan.
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Session
+
+from .schema import Apps, Leaderboards, Users
+
+bakery = baked.bakery()
+
+appQuery = bakery(lambda store: store.query(Apps))
+userQuery = bakery(lambda store: store.query(Users))
+userScoresQuery = bakery(lambda store: store.query(Leaderboards.scoreName,
+                                                   Leaderboards.value))
+userScoresQuery += lambda query: query.filter(Leaderboards.userId == bindparam('userId'),
+                                              Leaderboards.appId == bindparam('appId'))
+
+# name: (parameters types, statement)
+PREPARED_STATEMENTS = {
+    'user_rank': ('uuid, varchar, uuid', """
+        SELECT count(*) FILTER (WHERE value < (SELECT value FROM leaderboards
+                                               WHERE app_id = $1 AND score_name = $2
+                                                     AND user_id = $3)),
+               count(*)
+        FROM leaderboards
+        WHERE app_id = $1 AND score_name = $2
+    """),
+    'user_score': ('uuid, varchar, uuid', """
+        SELECT value FROM leaderboards
+        WHERE app_id = $1 AND score_name = $2 AND user_id = $3
+    """),
+    'top_scores': ('uuid, varchar, int', """
+        SELECT users.nickname, leaderboards.value
+        FROM leaderboards JOIN users ON users.id = leaderboards.user_id
+        WHERE leaderboards.app_id = $1 AND leaderboards.score_name = $2
+        ORDER BY leaderboards.value DESC
+        LIMIT $3
+    """),
+}
+
+_prepare = {name: text(f"PREPARE {name} ({types}) AS {statement}")
+            for name, (types, statement) in PREPARED_STATEMENTS.items()}
+_execute = {name: text(f"EXECUTE {name} (" +
+                       ", ".join(f":p{i}" for i in range(len(types.split(",")))) + ")")
+            for name, (types, _) in PREPARED_STATEMENTS.items()}
+
+
+def getApp(store: Session, appId: str):
+    """ app by id, None if not found
+    """
+    return appQuery.for_session(store).get(appId)
+
+def getUserById(store: Session, userId: str):
+    """ user by id, None if not found
+    """
+    return userQuery.for_session(store).get(userId)
+
+def getUserScores(store: Session, appId: str, userId: str):
+    """ (scoreName, value) of a user in an app
+    """
+    return userScoresQuery.for_session(store).params(appId=appId, userId=userId).all()
+
+def prepare(connection: Connection, name: str):
+    """ prepare the statement `name` on this pooled connection, unless it already was
+    """
+    prepared = connection.info.setdefault('prepared', set())
+    if name not in prepared:
+        connection.execute(_prepare[name])
+        prepared.add(name)
+
+def execute(store: Session, name: str, *params):
+    """ execute the prepared statement `name` on the session's connection
+    """
+    connection = store.connection()
+    prepare(connection, name)
+    return connection.execute(_execute[name],
+                              {f'p{i}': param for i, param in enumerate(params)})
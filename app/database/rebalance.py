@@ -0,0 +1,109 @@
+"""
+Move an app's leaderboards from one shard to another while the service is running
+
+usage: python -m app.database.rebalance APP_ID SHARD
+
+SHARD is an index of the shards list: 0 for DATABASE_URL, then DATABASE_SHARDS.
+
+1. copy the app's scores (and the users they reference) to the target shard
+2. freeze the app in the directory: writes get a 503 while reads keep hitting the source
+3. once every worker has seen the freeze, copy the scores updated since step 1 began
+4. pin the app to the target shard and unfreeze it
+5. once every worker has seen the new placement, delete the source rows
+
+Scores deleted during step 1 (development-only endpoints) are not carried over.
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import sys
+from datetime import datetime, timedelta
+from time import sleep
+from typing import Optional
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from . import SHARD_MAP_TTL, Database, normalizeAppId
+from .schema import Apps, AppShards, Leaderboards, Users
+from .shards import insertBatches, streamRows
+
+# margin added to SHARD_MAP_TTL for requests started just before a directory reload
+GRACE_PERIOD = 1
+# seconds of updates copied again, for transactions started before a copy but
+# committed after it read the scores
+CLOCK_MARGIN = 60
+
+
+def copyApp(appId: str, source: Database, target: Database,
+            since: Optional[datetime]=None):
+    """ upsert onto `target` the app's scores updated on `source` since `since` (all of
+        them if None), with the app and the users they reference; return their count
+    """
+    scores = Leaderboards.__table__
+    criteria = [scores.c.app_id == appId]
+    if since is not None:
+        criteria.append(scores.c.updated >= since)
+    usersIds = select([scores.c.user_id]).where(and_(*criteria))
+    
+    insertBatches(target, insert(Apps.__table__).on_conflict_do_nothing(),
+                  streamRows(source, Apps.__table__, Apps.id == appId))
+    insertBatches(target, insert(Users.__table__).on_conflict_do_nothing(),
+                  streamRows(source, Users.__table__, Users.id.in_(usersIds)))
+    statement = insert(scores)
+    statement = statement.on_conflict_do_update(
+        index_elements=[scores.c.score_name, scores.c.user_id, scores.c.app_id],
+        set_={'value': statement.excluded.value,
+              'created': statement.excluded.created,
+              'updated': statement.excluded.updated})
+    return insertBatches(target, statement, streamRows(source, scores, *criteria))
+
+def setPlacement(database: Database, appId: str, shard: int, frozen: bool):
+    """ pin `appId` to `shard` in the directory of the primary database
+    """
+    with database.onShard(0, appId).transaction() as store:
+        store.merge(AppShards(appId=appId, shard=shard, frozen=frozen))
+
+def waitDirectoryReload():
+    """ wait until every worker reloaded the directory
+    """
+    sleep(SHARD_MAP_TTL + GRACE_PERIOD)
+
+def rebalance(appId: str, shard: int, database: type=Database):
+    """ move `appId` to `shard` of `database`, return its number of scores
+    """
+    if not 0 <= shard < len(database.shards):
+        raise ValueError(f"shard {shard} is not in [0, {len(database.shards)})")
+    appId = normalizeAppId(appId)
+    source = database(appId)
+    if source.frozen:
+        raise RuntimeError(f"app {appId} is already being moved")
+    if source.shard == shard:
+        return 0
+    target = database.onShard(shard, appId)
+    
+    with source.transaction() as store:
+        since = store.query(func.now()).scalar() - timedelta(seconds=CLOCK_MARGIN)
+    # leftovers of an interrupted move
+    with target.transaction() as store:
+        store.query(Leaderboards).filter_by(appId=appId).delete()
+    copyApp(appId, source, target)
+    setPlacement(source, appId, source.shard, frozen=True)
+    waitDirectoryReload()
+    try:
+        copyApp(appId, source, target, since)
+    except:
+        setPlacement(source, appId, source.shard, frozen=False)
+        raise
+    setPlacement(source, appId, shard, frozen=False)
+    waitDirectoryReload()
+    
+    with source.transaction() as store:
+        store.query(Leaderboards).filter_by(appId=appId).delete()
+    with target.transaction() as store:
+        return store.query(Leaderboards).filter_by(appId=appId).count()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or not sys.argv[2].isdigit() \
+       or int(sys.argv[2]) >= len(Database.shards):
+        sys.exit(__doc__)
+    print(f"{rebalance(sys.argv[1], int(sys.argv[2]))} scores moved")
@@ -7,9 +7,9 @@ from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.sql import func
-from sqlalchemy.types import DateTime, Integer, String
+from sqlalchemy.types import Boolean, DateTime, Integer, String
 
 from . import Database
 
@@ -44,6 +44,20 @@ class Leaderboards(Base):
     appId = Column('app_id', ForeignKey(Apps.id, ondelete='CASCADE'), primary_key=True)
     value = Column(Integer, nullable=False)
     created = Column(DateTime(True), server_default=func.now())
+    updated = Column(DateTime(True), server_default=func.now(), onupdate=func.now())
     
     user = relationship(Users)
     app = relationship(Apps)
+    
+    __table_args__ = (Index('ix_leaderboards_app_id_updated', 'app_id', 'updated'), )
+
+
+class AppShards(Base):
+    """ SQLAlchemy class for 'app_shards' table, the directory of apps pinned to a shard
+        (only meaningful on the primary database)
+    """
+    __tablename__ = "app_shards"
+    
+    appId = Column('app_id', ForeignKey(Apps.id, ondelete='CASCADE'), primary_key=True)
+    shard = Column(Integer, nullable=False)
+    frozen = Column(Boolean, nullable=False, server_default=text('false'))
@@ -0,0 +1,108 @@
+"""
+Shards maintenance
+
+usage: python -m app.database.shards create-app NAME
+       python -m app.database.shards pin
+       python -m app.database.shards sync [SHARD]
+
+create-app  create an app on every shard and pin it to its shard in the directory
+pin         pin every app missing from the directory to the shard it is hashed to;
+            run it before changing DATABASE_SHARDS, the hash depends on it
+sync        copy the replicated tables (users, apps) from the primary database onto
+            SHARD, or onto every shard having no app yet (i.e. newly added shards);
+            build/prestart.sh runs it before the workers start
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import sys
+from itertools import islice
+from typing import Optional
+from uuid import UUID, uuid4
+
+from sqlalchemy.dialects.postgresql import insert
+
+from . import Database, hashShard
+from .schema import Apps, AppShards, Users
+
+BATCH_SIZE = 1000
+
+
+def streamRows(source: Database, table, *criteria):
+    """ rows of `table` matching `criteria` as dicts, fetched BATCH_SIZE at a time
+    """
+    with source.transaction() as store:
+        query = store.query(*table.columns).filter(*criteria).yield_per(BATCH_SIZE)
+        for row in query:
+            yield row._asdict()
+
+def insertBatches(target: Database, statement, rows):
+    """ execute the insert `statement` on `target` for each of `rows`, one transaction
+        per BATCH_SIZE rows; return the number of rows
+    """
+    count = 0
+    rows = iter(rows)
+    batch = list(islice(rows, BATCH_SIZE))
+    while batch:
+        with target.transaction() as store:
+            store.execute(statement, batch)
+        count += len(batch)
+        batch = list(islice(rows, BATCH_SIZE))
+    return count
+
+def syncShard(database: type, shard: int):
+    """ copy the users and apps of the primary database onto `shard`, apps last so that
+        a shard with apps is known to be synced
+    """
+    primary = database.onShard(0)
+    target = database.onShard(shard)
+    for table in (Users.__table__, Apps.__table__):
+        insertBatches(target, insert(table).on_conflict_do_nothing(),
+                      streamRows(primary, table))
+
+def syncNewShards(database: type=Database):
+    """ sync every shard having no app yet, return their indexes
+    """
+    synced = []
+    for shard in range(1, len(database.shards)):
+        with database.onShard(shard).transaction() as store:
+            isNew = store.query(Apps.id).first() is None
+        if isNew:
+            syncShard(database, shard)
+            synced.append(shard)
+    return synced
+
+def createApp(name: str, appId: Optional[str]=None, database: type=Database):
+    """ create an app on every shard and pin it to its shard, return its id
+    """
+    appId = UUID(appId) if appId is not None else uuid4()
+    shard = hashShard(appId.hex, len(database.shards))
+    with database().broadcast() as (primary, *replicas):
+        for store in (primary, *replicas):
+            store.add(Apps(id=appId, name=name))
+            store.flush()
+        primary.add(AppShards(appId=appId, shard=shard))
+    return appId.hex
+
+def pinApps(database: type=Database):
+    """ pin the apps missing from the directory to their hashed shard, return their count
+    """
+    with database.onShard(0).transaction() as store:
+        unpinned = store.query(Apps.id).filter(~Apps.id.in_(store.query(AppShards.appId)))
+        shardsCount = len(database.shards)
+        placements = [AppShards(appId=appId, shard=hashShard(str(appId), shardsCount))
+                      for (appId, ) in unpinned]
+        store.add_all(placements)
+    return len(placements)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'create-app':
+        print(createApp(sys.argv[2]))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'pin':
+        print(f"{pinApps()} apps pinned")
+    elif len(sys.argv) == 3 and sys.argv[1] == 'sync':
+        syncShard(Database, int(sys.argv[2]))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'sync':
+        print(f"shards synced: {syncNewShards()}")
+    else:
+        sys.exit(__doc__)
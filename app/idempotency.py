@@ -0,0 +1,280 @@
+"""
+Idempotency keys: a retried write carrying the same 'Idempotency-Key' header is
+answered with the response of the first attempt, without touching the database
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import asyncio
+import fcntl
+import json
+import os
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+from typing import Optional
+
+from starlette.responses import JSONResponse
+
+from .strings import REQUEST_IN_PROGRESS
+
+# seconds during which a response is replayed
+TTL = float(os.environ.get('IDEMPOTENCY_TTL', 3600))
+# maximum number of responses kept
+MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+# seconds a duplicate waits for the request it duplicates before getting a 409
+WAIT_TIMEOUT = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', 30))
+# directory (preferably on a tmpfs, e.g. /dev/shm/leaderboard-idempotency) shared by
+# the workers of a host; responses are per worker if unset
+SHARED_PATH = os.environ.get('IDEMPOTENCY_SHARED_PATH')
+HEADER = b'idempotency-key'
+METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class MemoryStore():
+    """ responses of a single worker, in insertion (thus expiration) order
+    """
+    def __init__(self, ttl: float=TTL, maxKeys: int=MAX_KEYS):
+        self.ttl = ttl
+        self.maxKeys = maxKeys
+        self.responses = OrderedDict()
+        self.inFlight = {}
+    
+    def get(self, key: str, now: Optional[float]=None):
+        """ response stored for `key`, None if there is none
+        """
+        now = time() if now is None else now
+        entry = self.responses.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+    
+    def claim(self, key: str):
+        """ mark `key` as being executed, False if it already is
+        """
+        if key in self.inFlight:
+            return False
+        self.inFlight[key] = asyncio.Event()
+        return True
+    
+    async def wait(self, key: str, timeout: float):
+        """ wait until `key` is not executed anymore, at most `timeout` seconds
+        """
+        event = self.inFlight.get(key)
+        if event is not None:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def put(self, key: str, response: dict, now: Optional[float]=None):
+        """ store the response of `key`, evicting expired and oldest responses
+        """
+        now = time() if now is None else now
+        self.responses.pop(key, None)
+        self.responses[key] = (now + self.ttl, response)
+        while self.responses:
+            expiresAt, _ = next(iter(self.responses.values()))
+            if expiresAt > now and len(self.responses) <= self.maxKeys:
+                break
+            self.responses.popitem(last=False)
+        self.release(key)
+    
+    def release(self, key: str):
+        """ mark `key` as not executed anymore, waking its duplicates up
+        """
+        event = self.inFlight.pop(key, None)
+        if event is not None:
+            event.set()
+
+
+class FileStore():
+    """ responses shared by the worker processes of a host, one JSON file per key;
+        a key being executed has a lock file, flock-ed by its worker (so a dead
+        worker's lock is released by the kernel)
+    """
+    pollInterval = 0.05
+    
+    def __init__(self, path: str=SHARED_PATH, ttl: float=TTL, maxKeys: int=MAX_KEYS):
+        self.path = path
+        self.ttl = ttl
+        self.maxKeys = maxKeys
+        self.nextCleanup = 0
+        self.locks = {}
+        os.makedirs(path, exist_ok=True)
+    
+    def get(self, key: str, now: Optional[float]=None):
+        """ response stored for `key`, None if there is none
+        """
+        now = time() if now is None else now
+        try:
+            with open(os.path.join(self.path, f"{key}.json")) as file:
+                expiresAt, response = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return response if expiresAt > now else None
+    
+    def claim(self, key: str):
+        """ mark `key` as being executed, False if it already is
+        """
+        lock = os.path.join(self.path, f"{key}.lock")
+        fd = os.open(lock, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the lock file may have been released (unlinked) since we opened it
+            if os.fstat(fd).st_ino != os.stat(lock).st_ino:
+                raise FileNotFoundError(lock)
+        except (BlockingIOError, FileNotFoundError):
+            os.close(fd)
+            return False
+        self.locks[key] = fd
+        return True
+    
+    async def wait(self, key: str, timeout: float): # pylint: disable=unused-argument
+        """ give the worker executing `key` some time
+        """
+        await asyncio.sleep(min(self.pollInterval, timeout))
+    
+    def put(self, key: str, response: dict, now: Optional[float]=None):
+        """ store the response of `key`, evicting expired and oldest responses from
+            time to time
+        """
+        now = time() if now is None else now
+        temporary = os.path.join(self.path, f"{key}.{os.getpid()}.tmp")
+        with open(temporary, 'w') as file:
+            json.dump([now + self.ttl, response], file)
+        os.replace(temporary, os.path.join(self.path, f"{key}.json"))
+        self.release(key)
+        if now >= self.nextCleanup:
+            self.nextCleanup = now + self.ttl / 10
+            asyncio.get_event_loop().run_in_executor(None, self.cleanup, now)
+    
+    def release(self, key: str):
+        """ mark `key` as not executed anymore, the lock file is removed while locked
+        """
+        fd = self.locks.pop(key, None)
+        if fd is not None:
+            os.remove(os.path.join(self.path, f"{key}.lock"))
+            os.close(fd)
+    
+    def cleanup(self, now: float):
+        """ remove expired responses, then the oldest ones above `maxKeys`, and the
+            lock files left by dead workers
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.lock'):
+                self.removeUnusedLock(entry.path)
+            elif entry.name.endswith('.json'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        expired = sum(1 for (modified, _) in entries if modified + self.ttl <= now)
+        for _, path in entries[:max(expired, len(entries) - self.maxKeys)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    @staticmethod
+    def removeUnusedLock(lock: str):
+        """ remove `lock` unless a worker holds it
+        """
+        try:
+            fd = os.open(lock, os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # released since we opened it, `lock` may now be another worker's lock file
+            if os.fstat(fd).st_ino == os.stat(lock).st_ino:
+                os.remove(lock)
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        finally:
+            os.close(fd)
+
+
+class IdempotencyMiddleware():
+    """ ASGI middleware replaying the stored response of writes already executed with
+        the same idempotency key, and collapsing concurrent duplicates into one execution
+    """
+    def __init__(self, app, store=None):
+        self.app = app
+        if store is None:
+            store = FileStore() if SHARED_PATH else MemoryStore()
+        self.store = store
+    
+    async def __call__(self, scope, receive, send):
+        key = self.key(scope) if scope['type'] == 'http' else None
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        
+        deadline = time() + WAIT_TIMEOUT
+        while True:
+            response = self.store.get(key)
+            if response is None and self.store.claim(key):
+                # the executing worker may have stored its response and released the
+                # key between the lookup and the claim
+                response = self.store.get(key)
+                if response is None:
+                    break
+                self.store.release(key)
+            if response is not None:
+                await self.replay(response, send)
+                return
+            if time() >= deadline:
+                await JSONResponse({'detail': REQUEST_IN_PROGRESS},
+                                   status_code=409)(scope, receive, send)
+                return
+            await self.store.wait(key, deadline - time())
+        
+        response = {'status': None, 'headers': [], 'body': ''}
+        async def capture(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = [[name.decode('latin-1'), value.decode('latin-1')]
+                                       for name, value in message.get('headers', [])]
+            elif message['type'] == 'http.response.body':
+                response['body'] += message.get('body', b'').decode('latin-1')
+            await send(message)
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            # server errors, rate limiting and migrations are transient: not replayed
+            if response['status'] is not None and response['status'] < 500 \
+               and response['status'] != 429:
+                self.store.put(key, response)
+            else:
+                self.store.release(key)
+    
+    @staticmethod
+    def key(scope):
+        """ store key of a write request carrying an idempotency key, None otherwise;
+            the whole request is part of it, so a reused key with other parameters
+            or another checksum is executed
+        """
+        if scope['method'] not in METHODS:
+            return None
+        headers = dict(scope['headers'])
+        idempotencyKey = headers.get(HEADER)
+        if idempotencyKey is None:
+            return None
+        request = b'\n'.join((idempotencyKey, scope['method'].encode(),
+                              scope['path'].encode(), scope['query_string'],
+                              headers.get(b'checksum', b'')))
+        return sha256(request).hexdigest()
+    
+    @staticmethod
+    async def replay(response: dict, send):
+        """ send a stored response
+        """
+        headers = [(name.encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response['headers']]
+        headers.append((b'idempotent-replayed', b'true'))
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': response['body'].encode('latin-1')})
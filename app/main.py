@@ -3,23 +3,30 @@ Leaderboard App
 
 @author: Jad Haddad <jad.haddad92@gmail.com> 2020
 """
+import logging
 from datetime import datetime
-from hashlib import sha1
 from os import environ
 from typing import Optional
 
 from fastapi import Depends, FastAPI, Header, HTTPException, status
-from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
+from . import warmup
+from .checksum import computeChecksum
 from .database import Database
-from .database.schema import Apps, Leaderboards, Users
+from .database.queries import execute, getApp, getUserById, getUserScores
+from .database.schema import Leaderboards, Users
+from .idempotency import IdempotencyMiddleware
 from .models import CreateUser, TopScoresResponseModel, UserModel, UserRank
-from .strings import (APP_NOT_FOUND, CHECKSUM_MISMATCH, NO_CHECKSUM,
-                      SCORENAME_NOT_FOUND, USER_ALREADY_REGISTERED,
-                      USER_NOT_FOUND)
+from .ratelimit import RateLimitMiddleware
+from .strings import (APP_MIGRATING, APP_NOT_FOUND, CHECKSUM_MISMATCH,
+                      NO_CHECKSUM, NOT_READY, SCORENAME_NOT_FOUND,
+                      USER_ALREADY_REGISTERED, USER_NOT_FOUND)
 
 production = environ.get('SERVER_TYPE', 'production') == 'production'
+warmUpOnStartup = environ.get('WARMUP', '1') == '1'
+logger = logging.getLogger(__name__)
 
 if production:
     docsURL = None
@@ -29,18 +36,32 @@ else:
     redocURL = "/redoc"
 
 app = FastAPI(docs_url=docsURL, redoc_url=redocURL)
+# the last added middleware runs first: duplicates are rate limited too
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(RateLimitMiddleware)
 
-def computeChecksum(**kwargs):
-    """ Compute checksum for parameters
+@app.on_event("startup")
+def startup():
+    """ Warm the worker up before it accepts requests
     """
-    concat = ""
-    for key in sorted(kwargs):
-        concat += key
-        value = kwargs[key]
-        if value is not None:
-            concat += str(kwargs[key])
-    concat += environ.get('APP_SECRET')
-    return sha1(concat.encode()).hexdigest()
+    app.openapi()
+    if warmUpOnStartup:
+        try:
+            warmup.warmUp(app.dependency_overrides.get(Database, Database))
+        except Exception:
+            logger.exception("warm-up failed, retried on next readiness check")
+
+@app.get("/ready", tags=['Health'])
+def ready():
+    """ Readiness probe, OK once the worker is warmed up
+    """
+    if not warmup.warmedUp:
+        try:
+            warmup.warmUp(app.dependency_overrides.get(Database, Database))
+        except Exception:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail=NOT_READY)
+    return {'ready': True}
 
 def validateParameters(**kwargs):
     """ Validate parameters checksum
@@ -54,6 +75,40 @@ def validateParameters(**kwargs):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=CHECKSUM_MISMATCH)
 
+def checkWritable(db: Database):
+    """ Reject writes to an app while it is being moved between shards
+    """
+    if db.frozen:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=APP_MIGRATING)
+
+def rankUser(store: Session, appId: str, scoreName: str, userId: str):
+    """ Compute user rank in percentage within an open transaction, so that callers
+        holding a session do not check a second connection out of the pool
+    """
+    appDB = getApp(store, appId)
+    if appDB is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=APP_NOT_FOUND)
+    
+    lowerScores, scoresCount = execute(store, 'user_rank', appId, scoreName,
+                                       userId).first()
+    if scoresCount == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=SCORENAME_NOT_FOUND)
+    
+    if scoresCount == 1:
+        percentile = 100
+        rank = 1
+    else:
+        percentile = (lowerScores * 100) // (scoresCount - 1)
+        rank = scoresCount - lowerScores
+    
+    return {
+        'percentile': percentile,
+        'rank': rank
+    }
+
 @app.post("/user", response_model=CreateUser, status_code=status.HTTP_201_CREATED,
           tags=['User'])
 def createUser(userId: str, nickname: Optional[str]=None, checksum: str=Header(None),
@@ -64,15 +119,15 @@ def createUser(userId: str, nickname: Optional[str]=None, checksum: str=Header(N
     if nickname in ('', None):
         nickname = f"user_{str(datetime.utcnow().timestamp()).split('.')[1]}"
     try:
-        with db.transaction() as store:
-            user = Users(id=userId, nickname=nickname)
-            store.add(user)
-            store.flush()
-            store.expunge(user)
+        with db.broadcast() as (primary, *replicas):
+            primary.add(Users(id=userId, nickname=nickname))
+            primary.flush()
+            for store in replicas:
+                store.merge(Users(id=userId, nickname=nickname))
     except IntegrityError:
         raise HTTPException(status_code=401, detail=USER_ALREADY_REGISTERED)
     else:
-        return {'nickname': user.nickname}
+        return {'nickname': nickname}
 
 @app.get("/user", response_model=UserModel, tags=['User'])
 def getUser(appId: str, userId: str, checksum: str=Header(None), db=Depends(Database)):
@@ -80,19 +135,17 @@ def getUser(appId: str, userId: str, checksum: str=Header(None), db=Depends(Data
     """
     validateParameters(appId=appId, userId=userId, checksum=checksum)
     with db.transaction() as store:
-        appDB = store.query(Apps).get(appId)
+        appDB = getApp(store, appId)
         if appDB is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=APP_NOT_FOUND)
         
-        user = store.query(Users).get(userId)
+        user = getUserById(store, userId)
         if user is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=USER_NOT_FOUND)
         
-        scores = store.query(Leaderboards.scoreName, Leaderboards.value) \
-                      .filter_by(userId=userId, appId=appId) \
-                      .all()
+        scores = getUserScores(store, appId, userId)
         scores = list(map(lambda x: x._asdict(), scores))
         return {'id': userId, 'nickname': user.nickname, 'scores': scores}
 
@@ -102,10 +155,14 @@ def updateUser(nickname: str, userId: str, checksum: str=Header(None),
     """ Update user's nickname
     """
     validateParameters(userId=userId, nickname=nickname, checksum=checksum)
-    with db.transaction() as store:
-        user = store.query(Users).get(userId)
+    with db.broadcast() as (primary, *replicas):
+        user = primary.query(Users).get(userId)
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=USER_NOT_FOUND)
         user.nickname = nickname
-        store.merge(user)
+        for store in replicas:
+            store.query(Users).filter_by(id=userId).update({'nickname': nickname})
 
 if not production:
     @app.delete("/user", tags=['User'])
@@ -113,13 +170,15 @@ if not production:
         """ Delete user from database
         """
         validateParameters(userId=userId, checksum=checksum)
-        with db.transaction() as store:
-            user = store.query(Users).get(userId)
+        with db.broadcast() as (primary, *replicas):
+            user = primary.query(Users).get(userId)
             if user is not None:
-                store.delete(user)
+                primary.delete(user)
             else:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                     detail=USER_NOT_FOUND)
+            for store in replicas:
+                store.query(Users).filter_by(id=userId).delete()
 
 @app.get("/user/rank", response_model=UserRank, tags=['Leaderboard'])
 def getUserRank(appId: str, scoreName: str, userId: str, checksum: str=Header(None),
@@ -128,40 +187,7 @@ def getUserRank(appId: str, scoreName: str, userId: str, checksum: str=Header(No
     """
     validateParameters(appId=appId, scoreName=scoreName, userId=userId, checksum=checksum)
     with db.transaction() as store:
-        appDB = store.query(Apps).get(appId)
-        if appDB is None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=APP_NOT_FOUND)
-        
-        scoreNames = store.query(Leaderboards.scoreName) \
-                          .filter_by(appId=appId) \
-                          .distinct()
-        scoreNames = [val for (val, ) in scoreNames]
-        if scoreName not in scoreNames:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=SCORENAME_NOT_FOUND)
-        
-        userScore = store.query(Leaderboards.value) \
-                         .filter_by(userId=userId, appId=appId, scoreName=scoreName)
-        lowerScores = store.query(func.count(Leaderboards.value)) \
-                           .filter(Leaderboards.value < userScore,
-                                   Leaderboards.appId == appId,
-                                   Leaderboards.scoreName == scoreName) \
-                           .scalar()
-        scoresCount = store.query(func.count(Leaderboards.value)) \
-                           .filter_by(appId=appId, scoreName=scoreName) \
-                           .scalar()
-        if scoresCount == 1:
-            percentile = 100
-            rank = 1
-        else:
-            percentile = (lowerScores * 100) // (scoresCount - 1)
-            rank = scoresCount - lowerScores
-        
-        return {
-            'percentile': percentile,
-            'rank': rank
-        }
+        return rankUser(store, appId, scoreName, userId)
 
 @app.get("/leaderboard/top", response_model=TopScoresResponseModel, tags=['Leaderboard'])
 def getTopKScores(appId: str, userId: str, scoreName: str, k: int,
@@ -171,24 +197,13 @@ def getTopKScores(appId: str, userId: str, scoreName: str, k: int,
     validateParameters(appId=appId, userId=userId, scoreName=scoreName, k=k,
                        checksum=checksum)
     with db.transaction() as store:
-        topScores = store.query(Users.nickname, Leaderboards.value) \
-                         .join(Users).join(Apps) \
-                         .filter(Apps.id == appId, Leaderboards.scoreName == scoreName) \
-                         .order_by(Leaderboards.value.desc()) \
-                         .limit(k)
-        userScore = store.query(Leaderboards) \
-                         .join(Users).join(Apps) \
-                         .filter(Apps.id == appId, Leaderboards.scoreName == scoreName) \
-                         .filter(Users.id == userId) \
-                         .one_or_none()
-        
-        userRankChecksum = computeChecksum(appId=appId, userId=userId,
-                                           scoreName=scoreName)
-        userRank = getUserRank(appId, scoreName, userId, userRankChecksum, db)
-        rank = userRank['rank']
+        topScores = execute(store, 'top_scores', appId, scoreName, k)
+        userScore = execute(store, 'user_score', appId, scoreName, userId).scalar()
+        rank = rankUser(store, appId, scoreName, userId)['rank']
         return {
-            'scores': list(map(lambda x: x._asdict(), topScores.all())),
-            'userScore': userScore.value if userScore is not None else 0,
+            'scores': [{'nickname': nickname, 'value': value}
+                       for (nickname, value) in topScores],
+            'userScore': userScore if userScore is not None else 0,
             'userRank': rank if rank is not None else -1
         }
 
@@ -199,15 +214,14 @@ def addScore(appId: str, scoreName: str, value: int, userId: str,
     """
     validateParameters(appId=appId, scoreName=scoreName, value=value, userId=userId,
                        checksum=checksum)
+    checkWritable(db)
     with db.transaction() as store:
         leaderboard = Leaderboards(appId=appId, userId=userId, scoreName=scoreName,
                                    value=value)
         store.merge(leaderboard)
         
         store.commit()
-        userRankChecksum = computeChecksum(appId=appId, userId=userId,
-                                           scoreName=scoreName)
-        return getUserRank(appId, scoreName, userId, userRankChecksum, db)
+        return rankUser(store, appId, scoreName, userId)
 
 if not production:
     @app.delete("/leaderboard", tags=['Leaderboard'])
@@ -217,6 +231,7 @@ if not production:
         """
         validateParameters(appId=appId, scoreName=scoreName, userId=userId,
                            checksum=checksum)
+        checkWritable(db)
         with db.transaction() as store:
             score = store.query(Leaderboards) \
                         .filter_by(appId=appId, userId=userId, scoreName=scoreName) \
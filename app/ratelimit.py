@@ -0,0 +1,182 @@
+"""
+Token bucket rate limiting, enforced before requests reach the database
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import fcntl
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from hashlib import blake2b
+from math import ceil
+from time import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from .checksum import computeChecksum
+from .database import normalizeAppId
+from .strings import RATE_LIMITED
+
+# requests per second, and burst size, allowed for each (appId, userId)
+USER_RATE = float(os.environ.get('RATE_LIMIT_USER_RATE', 5))
+USER_BURST = float(os.environ.get('RATE_LIMIT_USER_BURST', 20))
+# requests per second, and burst size, allowed for a whole app
+APP_RATE = float(os.environ.get('RATE_LIMIT_APP_RATE', 200))
+APP_BURST = float(os.environ.get('RATE_LIMIT_APP_BURST', 400))
+# maximum number of buckets kept by a worker, or slots of the shared table
+MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 65536))
+# file (preferably on a tmpfs, e.g. /dev/shm/leaderboard-ratelimit) shared by the
+# workers of a host; buckets are per worker if unset
+SHARED_PATH = os.environ.get('RATE_LIMIT_SHARED_PATH')
+
+
+def refill(tokens: float, last: float, now: float, rate: float, burst: float):
+    """ tokens in a bucket at `now`, `tokens` being its content at `last`
+    """
+    return min(burst, tokens + (now - last) * rate)
+
+
+class MemoryBuckets():
+    """ token buckets of a single worker, the least recently used bucket is evicted
+        when the table is full (an idle bucket is full, evicting it loses nothing)
+    """
+    def __init__(self, maxKeys: int=MAX_KEYS):
+        self.maxKeys = maxKeys
+        self.buckets = OrderedDict()
+    
+    def take(self, key: str, rate: float, burst: float, now: Optional[float]=None):
+        """ take a token from `key`'s bucket, return the seconds to wait before a token
+            is available if there is none (0 if the token was taken)
+        """
+        now = time() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.maxKeys:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = [burst, now]
+        else:
+            self.buckets.move_to_end(key)
+        tokens = refill(bucket[0], bucket[1], now, rate, burst)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        bucket[0], bucket[1] = tokens - 1, now
+        return 0
+
+
+class SharedBuckets():
+    """ token buckets shared by the worker processes of a host, stored in a memory
+        mapped file of `maxKeys` slots grouped in sets of `ways` slots; a key may use
+        any slot of its set, the set is locked while it is updated, and a key without
+        a slot takes the least recently used one over
+    """
+    slot = struct.Struct('<8sdd')
+    empty = bytes(8)
+    ways = 4
+    
+    def __init__(self, path: str=SHARED_PATH, maxKeys: int=MAX_KEYS):
+        self.ways = min(self.ways, maxKeys)
+        self.sets = maxKeys // self.ways
+        self.setSize = self.slot.size * self.ways
+        size = self.setSize * self.sets
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.table = mmap.mmap(self.fd, size)
+    
+    def take(self, key: str, rate: float, burst: float, now: Optional[float]=None):
+        """ take a token from `key`'s bucket, return the seconds to wait before a token
+            is available if there is none (0 if the token was taken)
+        """
+        now = time() if now is None else now
+        digest = blake2b(key.encode(), digest_size=8).digest()
+        start = int.from_bytes(digest, 'little') % self.sets * self.setSize
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.setSize, start)
+        try:
+            slots = [(offset, ) + self.slot.unpack_from(self.table, offset)
+                     for offset in range(start, start + self.setSize, self.slot.size)]
+            owned = [slot for slot in slots if slot[1] == digest]
+            if owned:
+                offset, _, tokens, last = owned[0]
+            else:
+                # an empty slot, else the least recently used one, whose tokens are
+                # inherited: an idle bucket is full again, an active one does not hand
+                # a fresh burst out
+                offset, slotKey, tokens, last = min(
+                    slots, key=lambda slot: (slot[1] != self.empty, slot[3]))
+                if slotKey == self.empty:
+                    tokens, last = burst, now
+            tokens = refill(tokens, last, now, rate, burst)
+            if tokens < 1:
+                self.slot.pack_into(self.table, offset, digest, tokens, now)
+                return (1 - tokens) / rate
+            self.slot.pack_into(self.table, offset, digest, tokens - 1, now)
+            return 0
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.setSize, start)
+
+
+class RateLimitMiddleware():
+    """ ASGI middleware answering 429 to requests over their (appId, userId) or appId
+        budget, before they reach the application; requests without a valid checksum
+        are charged to separate buckets, so that nobody can spend the budget of others
+    """
+    def __init__(self, app, buckets=None):
+        self.app = app
+        if buckets is None:
+            buckets = SharedBuckets() if SHARED_PATH else MemoryBuckets()
+        self.buckets = buckets
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            checksum = dict(scope['headers']).get(b'checksum')
+            wait = self.check(scope, checksum)
+            if wait:
+                response = JSONResponse({'detail': RATE_LIMITED}, status_code=429,
+                                        headers={'Retry-After': str(ceil(wait))})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+    
+    def check(self, scope, checksum: Optional[bytes]):
+        """ seconds to wait before the request is allowed, 0 if it is allowed
+        """
+        declared = self.declaredParameters(scope)
+        if declared is None:
+            return 0
+        params = dict(parse_qsl(scope['query_string'].decode('latin-1'),
+                                keep_blank_values=True))
+        # the checksum the endpoint verifies: its own parameters, missing ones are None
+        expected = computeChecksum(**{name: params.get(name) for name in declared})
+        prefix = '' if checksum is not None and \
+                       checksum.decode('latin-1') == expected else 'unverified:'
+        appId = params.get('appId')
+        if appId is not None:
+            appId = normalizeAppId(appId)
+        userId = params.get('userId')
+        if userId is not None:
+            wait = self.buckets.take(f"{prefix}user:{appId}:{userId}", USER_RATE,
+                                     USER_BURST)
+            if wait:
+                return wait
+        if appId is not None:
+            return self.buckets.take(f"{prefix}app:{appId}", APP_RATE, APP_BURST)
+        return 0
+    
+    @staticmethod
+    def declaredParameters(scope):
+        """ names of the query parameters declared by the endpoint matching the
+            request, None if no endpoint matches (nothing reaches the database)
+        """
+        application = scope.get('app')
+        for route in getattr(application, 'routes', ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                dependant = getattr(route, 'dependant', None)
+                if dependant is None:
+                    return None
+                return [field.alias for field in dependant.query_params]
+        return None
@@ -1,6 +1,10 @@
+APP_MIGRATING = "App is being migrated, retry later"
 APP_NOT_FOUND = "App not found"
 CHECKSUM_MISMATCH = "Unauthorized access: checksum mismatch"
 NO_CHECKSUM = "Unauthorized access: no checksum"
+NOT_READY = "Server is warming up"
+RATE_LIMITED = "Too many requests, retry later"
+REQUEST_IN_PROGRESS = "A request with this idempotency key is in progress"
 SCORENAME_NOT_FOUND = "Score name not found"
 USER_ALREADY_REGISTERED = "User already registered"
 USER_NOT_FOUND = "User not found"
@@ -3,21 +3,28 @@ Unit tests using PyTest
 
 @author: Jad Haddad <jad.haddad92@gmail.com> 2020
 """
+import asyncio
+from os import environ
 from uuid import uuid4
 
+import pytest
 from fastapi.testclient import TestClient
 
-from .database import Database
-from .database.schema import Base, Apps, Users, Leaderboards
+from .database import Database, _placements, hashShard
+from .database import rebalance as rebalancing
+from .database.schema import Base, Apps, AppShards, Users, Leaderboards
+from .database.shards import createApp
+from .idempotency import FileStore, IdempotencyMiddleware, MemoryStore
 from .main import app, computeChecksum
+from .ratelimit import MemoryBuckets, SharedBuckets
 
 SQLALCHEMY_DATABASE_URL = "postgresql://postgres:secretpassword@db:5432/testtreederboards"
+# e.g. "postgresql://postgres:secretpassword@db:5432/testtreederboards_1,..."
+SHARDS_URLS = [SQLALCHEMY_DATABASE_URL] + \
+              [uri for uri in environ.get('TEST_DATABASE_SHARDS', '').split(',') if uri]
 
 class DatabaseTest(Database):
-    def __init__(self, uri: str=SQLALCHEMY_DATABASE_URL):
-        """ connect to SQLAlchemy database
-        """
-        super().__init__(uri)
+    shards = SHARDS_URLS
 
 app.dependency_overrides[Database] = DatabaseTest
 
@@ -28,9 +35,10 @@ userId = "userIdTest"
 scoreName = "arcade"
 
 def test_recreate_database():
-    engine = DatabaseTest().engine
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    for shard in range(len(SHARDS_URLS)):
+        engine = DatabaseTest.onShard(shard).engine
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
     
     with DatabaseTest().transaction() as store:
         apps = store.query(Apps).all()
@@ -75,6 +83,53 @@ def test_create_user():
     assert response.status_code == 401
     assert response.json() == {"detail":"User already registered"}
 
+def test_idempotent_create_user():
+    params = {"userId": uuid4().hex, "nickname": "testNickname3"}
+    headers = {"checksum": computeChecksum(**params), "Idempotency-Key": uuid4().hex}
+    response = client.post("/user", params=params, headers=headers)
+    assert response.status_code == 201
+    assert 'idempotent-replayed' not in response.headers
+    
+    response = client.post("/user", params=params, headers=headers)
+    assert response.status_code == 201
+    assert response.json() == {"nickname": "testNickname3"}
+    assert response.headers['idempotent-replayed'] == 'true'
+    
+    headers["Idempotency-Key"] = uuid4().hex
+    response = client.post("/user", params=params, headers=headers)
+    assert response.status_code == 401
+    assert response.json() == {"detail": "User already registered"}
+
+def test_idempotency_collapses_duplicates(tmp_path):
+    async def endpoint(scope, receive, send):
+        calls.append(scope['path'])
+        await asyncio.sleep(0.1)
+        await send({'type': 'http.response.start', 'status': 201, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+    
+    async def request(middleware):
+        scope = {'type': 'http', 'method': 'POST', 'path': '/user', 'query_string': b'',
+                 'headers': [(b'idempotency-key', b'key')]}
+        messages = []
+        async def send(message):
+            messages.append(message)
+        await middleware(scope, None, send)
+        return messages[0]['status']
+    
+    for store in (MemoryStore(), FileStore(str(tmp_path))):
+        calls = []
+        middleware = IdempotencyMiddleware(endpoint, store)
+        statuses = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(*(request(middleware) for _ in range(5))))
+        assert statuses == [201] * 5
+        assert calls == ['/user']
+    
+    store = MemoryStore(ttl=10, maxKeys=2)
+    for i, key in enumerate("abc"):
+        store.put(key, {}, now=i)
+    assert list(store.responses) == ["b", "c"]
+    assert store.get("b", now=11) is None
+
 def test_update_user():
     newNickname = "testNickname2"
     checksum = computeChecksum(userId=userId, nickname=newNickname)
@@ -83,10 +138,16 @@ def test_update_user():
     assert response.status_code == 200
 
 def test_create_app():
-    with DatabaseTest().transaction() as store:
-        app = Apps(id=appId, name="Twype")
-        store.add(app)
-        store.flush()
+    assert createApp("Twype", appId, DatabaseTest) == appId
+    assert DatabaseTest.locate(appId) == (hashShard(appId, len(SHARDS_URLS)), False)
+    with DatabaseTest.onShard(0).transaction() as store:
+        placement = store.query(AppShards).get(appId)
+        assert placement.shard == hashShard(appId, len(SHARDS_URLS))
+
+def test_ready():
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {'ready': True}
 
 def test_get_user():
     checksum = computeChecksum(userId=userId, appId=appId)
@@ -151,6 +212,33 @@ def test_top_scores():
         'userScore': 120
     }
 
+def test_rebalance(monkeypatch):
+    with pytest.raises(ValueError):
+        rebalancing.rebalance(appId, len(SHARDS_URLS), DatabaseTest)
+    if len(SHARDS_URLS) == 1:
+        pytest.skip("TEST_DATABASE_SHARDS is not set")
+    # instead of waiting for the workers, drop this process' copy of the directory
+    monkeypatch.setattr(rebalancing, 'waitDirectoryReload', _placements.clear)
+    source = hashShard(appId, len(SHARDS_URLS))
+    target = (source + 1) % len(SHARDS_URLS)
+    assert rebalancing.rebalance(appId, target, DatabaseTest) == 1
+    assert DatabaseTest.locate(appId) == (target, False)
+    with DatabaseTest.onShard(source).transaction() as store:
+        assert store.query(Leaderboards).filter_by(appId=appId).count() == 0
+    
+    k = 100
+    checksum = computeChecksum(userId=userId, appId=appId, scoreName=scoreName, k=k)
+    params = {"userId": userId, "appId": appId, "scoreName": scoreName, 'k': k}
+    response = client.get("/leaderboard/top",
+                          params=params,
+                          headers={"checksum": checksum})
+    assert response.status_code == 200
+    assert response.json() == {
+        'scores': [{'nickname': 'testNickname2', 'value': 120}],
+        'userRank': 1,
+        'userScore': 120
+    }
+
 def test_delete_score():
     checksum = computeChecksum(userId=userId, appId=appId, scoreName=scoreName)
     params = {"userId": userId, "appId": appId, "scoreName": scoreName}
@@ -177,3 +265,47 @@ def test_delete_user():
     response = _deleteUser()
     assert response.status_code == 404
     assert response.json() == {"detail":"User not found"}
+
+def test_rate_limit(tmp_path):
+    for buckets in (MemoryBuckets(maxKeys=2), SharedBuckets(tmp_path / "buckets", 2)):
+        assert buckets.take("a", rate=1, burst=2, now=0) == 0
+        assert buckets.take("a", rate=1, burst=2, now=0) == 0
+        assert buckets.take("a", rate=1, burst=2, now=0) == 1
+        assert buckets.take("a", rate=1, burst=2, now=0.5) == 0.5
+        assert buckets.take("a", rate=1, burst=2, now=1) == 0
+    
+    buckets = MemoryBuckets(maxKeys=2)
+    for key in ("a", "b", "c"):
+        buckets.take(key, rate=1, burst=1, now=0)
+    assert list(buckets.buckets) == ["b", "c"]
+    
+    # keys of a set have their own slots, a key taking a busy slot over gets no burst
+    buckets = SharedBuckets(tmp_path / "shared", 2)
+    assert buckets.take("a", rate=1, burst=1, now=0) == 0
+    assert buckets.take("b", rate=1, burst=1, now=0) == 0
+    assert buckets.take("a", rate=1, burst=1, now=0) == 1
+    buckets = SharedBuckets(tmp_path / "collisions", 1)
+    assert buckets.take("a", rate=1, burst=1, now=0) == 0
+    assert buckets.take("b", rate=1, burst=1, now=0) == 1
+    assert buckets.take("c", rate=1, burst=1, now=10) == 0
+    
+    # requests without a valid checksum are limited without spending the budget of
+    # signed ones
+    params = {"appId": appId, "userId": uuid4().hex}
+    responses = [client.get("/user", params=params) for _ in range(40)]
+    assert responses[0].status_code == 401
+    assert responses[-1].status_code == 429
+    
+    headers = {"checksum": computeChecksum(**params)}
+    responses = [client.get("/user", params=params, headers=headers) for _ in range(40)]
+    assert responses[0].status_code == 404
+    assert responses[-1].status_code == 429
+    assert responses[-1].json() == {'detail': 'Too many requests, retry later'}
+    
+    # neither undeclared nor omitted optional parameters escape the limit
+    params = {"userId": uuid4().hex}
+    headers = {"checksum": computeChecksum(nickname=None, **params)}
+    params["x"] = 1
+    responses = [client.post("/user", params=params, headers=headers) for _ in range(40)]
+    assert responses[0].status_code == 201
+    assert responses[-1].status_code == 429
@@ -0,0 +1,37 @@
+"""
+Worker warm-up: pay for connections, mappers configuration and queries compilation
+before the first request does
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+from sqlalchemy.orm import configure_mappers
+
+from .database import POOL_SIZE, Database
+from .database.queries import (PREPARED_STATEMENTS, execute, getApp, getUserById,
+                               getUserScores, prepare)
+
+# any id, the hot queries are only run to be compiled and planned
+NIL_UUID = '00000000000000000000000000000000'
+
+warmedUp = False
+
+
+def warmUp(database: type=Database):
+    """ configure mappers, fill every shard's pool with connections having the hot
+        statements prepared, and compile the baked queries
+    """
+    global warmedUp # pylint: disable=global-statement
+    configure_mappers()
+    for shard in range(len(database.shards)):
+        db = database.onShard(shard)
+        connections = [db.engine.connect() for _ in range(POOL_SIZE)]
+        for connection in connections:
+            for name in PREPARED_STATEMENTS:
+                prepare(connection, name)
+            connection.close()
+        with db.transaction() as store:
+            getApp(store, NIL_UUID)
+            getUserById(store, NIL_UUID)
+            getUserScores(store, NIL_UUID, NIL_UUID)
+            execute(store, 'user_rank', NIL_UUID, '', NIL_UUID).first()
+    warmedUp = True
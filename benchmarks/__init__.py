@@ -0,0 +1,5 @@
+"""
+Benchmarks, run from the repository root with `python -m benchmarks.<name>`
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
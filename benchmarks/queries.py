@@ -0,0 +1,120 @@
+"""
+Per-request CPU spent in the ORM layer and Postgres planning time, before and after
+baked queries and prepared statements
+
+usage: DATABASE_URL=... python -m benchmarks.queries [ITERATIONS]
+
+A throwaway app with SCORES_COUNT scores is created, and deleted at the end.
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import re
+import sys
+from time import perf_counter, process_time
+from uuid import uuid4
+
+from sqlalchemy import func, text
+
+from app.database import Database
+from app.database.queries import PREPARED_STATEMENTS, execute, getApp
+from app.database.schema import Apps, Base, Leaderboards, Users
+
+SCORES_COUNT = 10000
+SCORE_NAME = "benchmark"
+
+
+def legacyUserRank(store, appId, userId):
+    """ getUserRank queries as they were built on every request
+    """
+    store.query(Apps).get(appId)
+    scoreNames = store.query(Leaderboards.scoreName).filter_by(appId=appId).distinct()
+    assert SCORE_NAME in [val for (val, ) in scoreNames]
+    userScore = store.query(Leaderboards.value) \
+                     .filter_by(userId=userId, appId=appId, scoreName=SCORE_NAME)
+    store.query(func.count(Leaderboards.value)) \
+         .filter(Leaderboards.value < userScore,
+                 Leaderboards.appId == appId,
+                 Leaderboards.scoreName == SCORE_NAME) \
+         .scalar()
+    store.query(func.count(Leaderboards.value)) \
+         .filter_by(appId=appId, scoreName=SCORE_NAME) \
+         .scalar()
+
+def userRank(store, appId, userId):
+    """ getUserRank queries as they are now
+    """
+    getApp(store, appId)
+    execute(store, 'user_rank', appId, SCORE_NAME, userId).first()
+
+def measure(database, function, appId, userId, iterations):
+    """ (CPU ms, wall ms) per call of `function`
+    """
+    with database.transaction() as store:
+        function(store, appId, userId)
+        cpu, wall = process_time(), perf_counter()
+        for _ in range(iterations):
+            function(store, appId, userId)
+        cpu, wall = process_time() - cpu, perf_counter() - wall
+    return cpu * 1000 / iterations, wall * 1000 / iterations
+
+def planningTime(store, statement, params, iterations):
+    """ average Postgres planning time of `statement` in ms
+    """
+    total = 0
+    for _ in range(iterations):
+        plan = store.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}"),
+                             params).scalar()
+        total += plan[0]['Planning Time']
+    return total / iterations
+
+def comparePlanning(database, appId, userId, iterations):
+    """ planning time of every prepared statement, sent as plain SQL vs executed
+    """
+    args = {'user_rank': (appId, SCORE_NAME, userId),
+            'user_score': (appId, SCORE_NAME, userId),
+            'top_scores': (appId, SCORE_NAME, 100)}
+    with database.transaction() as store:
+        for name, (_, statement) in PREPARED_STATEMENTS.items():
+            params = {f'p{i}': param for i, param in enumerate(args[name])}
+            plain = re.sub(r'\$(\d+)', lambda match: f':p{int(match[1]) - 1}', statement)
+            # Postgres switches to a cached generic plan after 5 executions
+            for _ in range(6):
+                execute(store, name, *args[name])
+            placeholders = ', '.join(f':{param}' for param in params)
+            yield (name,
+                   planningTime(store, plain, params, iterations),
+                   planningTime(store, f"EXECUTE {name} ({placeholders})", params,
+                                iterations))
+
+def main(iterations: int):
+    """ run the benchmark on a throwaway app
+    """
+    database = Database()
+    Base.metadata.create_all(database.engine)
+    appId = uuid4().hex
+    usersIds = [uuid4().hex for _ in range(SCORES_COUNT)]
+    with database.transaction() as store:
+        store.add(Apps(id=appId, name="benchmark"))
+        store.add_all([Users(id=userId, nickname=userId[:30]) for userId in usersIds])
+        store.flush()
+        store.add_all([Leaderboards(appId=appId, userId=userId, scoreName=SCORE_NAME,
+                                    value=value)
+                       for value, userId in enumerate(usersIds)])
+    try:
+        userId = usersIds[SCORES_COUNT // 2]
+        for label, function in (("legacy", legacyUserRank), ("current", userRank)):
+            cpu, wall = measure(database, function, appId, userId, iterations)
+            print(f"getUserRank {label}: {cpu:.3f} ms CPU, "
+                  f"{wall:.3f} ms wall per request")
+        for name, plain, prepared in comparePlanning(database, appId, userId, iterations):
+            print(f"{name} planning: {plain:.3f} ms plain SQL, "
+                  f"{prepared:.3f} ms prepared")
+    finally:
+        with database.transaction() as store:
+            store.query(Apps).filter_by(id=appId).delete()
+            store.query(Users).filter(Users.id.in_(usersIds)) \
+                 .delete(synchronize_session=False)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
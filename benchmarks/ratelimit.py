@@ -0,0 +1,76 @@
+"""
+Overhead of the rate limiter per request, route lookup and checksum included
+
+usage: python -m benchmarks.ratelimit [ITERATIONS]
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import asyncio
+import sys
+from os import environ
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+from urllib.parse import urlencode
+from uuid import uuid4
+
+environ.setdefault('DATABASE_URL', 'postgresql://')
+environ.setdefault('APP_SECRET', 'benchmark')
+
+# pylint: disable=wrong-import-position
+from app.checksum import computeChecksum
+from app.main import app
+from app.ratelimit import MemoryBuckets, RateLimitMiddleware, SharedBuckets
+
+KEYS_COUNT = 10000
+
+
+async def endpoint(scope, receive, send):
+    """ ASGI application doing nothing
+    """
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def receive():
+    """ empty request body
+    """
+    return {'type': 'http.request', 'body': b''}
+
+async def send(message):
+    """ drop the response
+    """
+
+async def measure(application, scopes, iterations):
+    """ microseconds per request through `application`
+    """
+    start = perf_counter()
+    for i in range(iterations):
+        await application(scopes[i % KEYS_COUNT], receive, send)
+    return (perf_counter() - start) * 1e6 / iterations
+
+def main(iterations: int):
+    """ compare the bare application with the limited ones
+    """
+    appId = uuid4().hex
+    scopes = []
+    for i in range(KEYS_COUNT):
+        params = {'appId': appId, 'userId': f"user{i}", 'scoreName': "arcade",
+                  'value': str(i)}
+        scopes.append({'type': 'http', 'method': 'POST', 'path': '/leaderboard',
+                       'app': app,
+                       'headers': [(b'checksum', computeChecksum(**params).encode())],
+                       'query_string': urlencode(params).encode()})
+    with NamedTemporaryFile() as sharedFile:
+        applications = (
+            ("no limiter", endpoint),
+            ("memory buckets", RateLimitMiddleware(endpoint, MemoryBuckets())),
+            ("shared buckets", RateLimitMiddleware(endpoint,
+                                                   SharedBuckets(sharedFile.name))),
+        )
+        loop = asyncio.get_event_loop()
+        for label, application in applications:
+            elapsed = loop.run_until_complete(measure(application, scopes, iterations))
+            print(f"{label}: {elapsed:.2f} us per request")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
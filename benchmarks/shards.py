@@ -0,0 +1,72 @@
+"""
+Throughput of score submissions with 1..N shards
+
+usage: DATABASE_URL=... DATABASE_SHARDS=url1,url2 python -m benchmarks.shards [SECONDS]
+
+Every shard database is DROPPED and recreated, only point it to throwaway databases.
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from os import environ
+from time import monotonic
+from uuid import uuid4
+
+environ.setdefault('APP_SECRET', 'benchmark')
+
+# pylint: disable=wrong-import-position
+from app.database import SHARDS_URLS, Database
+from app.database.schema import Apps, Base, Users
+from app.main import addScore, computeChecksum
+
+APPS_COUNT = 16
+USERS_COUNT = 64
+THREADS_COUNT = 32
+
+
+def setUp(database: type):
+    """ recreate the schema on every shard, with the same apps and users everywhere
+    """
+    appsIds = [uuid4().hex for _ in range(APPS_COUNT)]
+    usersIds = [uuid4().hex for _ in range(USERS_COUNT)]
+    for shard in range(len(database.shards)):
+        engine = database.onShard(shard).engine
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    with database().broadcast() as stores:
+        for store in stores:
+            store.add_all([Apps(id=appId, name=appId[:30]) for appId in appsIds])
+            store.add_all([Users(id=userId, nickname=userId[:30]) for userId in usersIds])
+    return appsIds, usersIds
+
+def run(database: type, seconds: float):
+    """ submit scores from THREADS_COUNT threads during `seconds`, return requests/s
+    """
+    appsIds, usersIds = setUp(database)
+    deadline = monotonic() + seconds
+    
+    def worker(offset: int):
+        done = 0
+        for i in count(offset):
+            if monotonic() > deadline:
+                return done
+            appId = appsIds[i % APPS_COUNT]
+            userId = usersIds[(i // APPS_COUNT) % USERS_COUNT]
+            checksum = computeChecksum(appId=appId, scoreName="arcade", value=i,
+                                       userId=userId)
+            addScore(appId, "arcade", i, userId, checksum, database(appId))
+            done += 1
+    
+    with ThreadPoolExecutor(THREADS_COUNT) as executor:
+        done = sum(executor.map(worker, range(THREADS_COUNT)))
+    return done / seconds
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for shardsCount in range(1, len(SHARDS_URLS) + 1):
+        shardedDatabase = type('ShardedDatabase', (Database, ),
+                               {'shards': SHARDS_URLS[:shardsCount]})
+        print(f"{shardsCount} shard(s): {run(shardedDatabase, duration):.0f} requests/s")
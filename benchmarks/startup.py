@@ -0,0 +1,80 @@
+"""
+Time to first fast response of a new worker, with and without warm-up
+
+usage: DATABASE_URL=... python -m benchmarks.startup [PORT]
+
+A response is fast when its latency is within FAST_FACTOR of the steady state median.
+
+@author: Jad Haddad <jad.haddad92@gmail.com> 2021
+"""
+import subprocess
+import sys
+from os import environ
+from statistics import median
+from time import perf_counter, sleep
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+environ.setdefault('APP_SECRET', 'benchmark')
+
+# pylint: disable=wrong-import-position
+from app.main import computeChecksum
+
+FAST_FACTOR = 2
+STEADY_REQUESTS = 200
+
+
+def getUser(port: int):
+    """ latency of a GET /user for an unknown app, which goes through the database
+    """
+    params = {'appId': uuid4().hex, 'userId': uuid4().hex}
+    request = Request(f"http://127.0.0.1:{port}/user?{urlencode(params)}",
+                      headers={'checksum': computeChecksum(**params)})
+    start = perf_counter()
+    try:
+        urlopen(request)
+    except HTTPError as error:
+        assert error.code == 404, error.code
+    return perf_counter() - start
+
+def run(port: int, warmUp: bool):
+    """ (seconds to first response, first latency, seconds to first fast response)
+    """
+    env = dict(environ, WARMUP='1' if warmUp else '0')
+    start = perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app',
+                               '--port', str(port), '--log-level', 'warning'], env=env)
+    try:
+        latencies = []
+        while not latencies:
+            try:
+                latencies.append(getUser(port))
+            except URLError:
+                sleep(0.01)
+        firstResponse = perf_counter() - start
+        timestamps = [firstResponse]
+        for _ in range(STEADY_REQUESTS):
+            latencies.append(getUser(port))
+            timestamps.append(perf_counter() - start)
+        steady = median(latencies[STEADY_REQUESTS // 2:])
+        firstFast = next(timestamp for timestamp, latency in zip(timestamps, latencies)
+                         if latency <= FAST_FACTOR * steady)
+        return firstResponse, latencies[0], firstFast
+    finally:
+        server.terminate()
+        server.wait()
+
+def main(port: int):
+    """ compare a cold worker with a warmed up one
+    """
+    for warmUp in (False, True):
+        firstResponse, firstLatency, firstFast = run(port, warmUp)
+        print(f"warm-up {'on' if warmUp else 'off'}: first response after "
+              f"{firstResponse * 1000:.0f} ms ({firstLatency * 1000:.1f} ms latency), "
+              f"first fast response after {firstFast * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8001)
@@ -5,8 +5,14 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     CREATE USER leaderboard;
     CREATE DATABASE treederboards;
     CREATE DATABASE testtreederboards;
+    CREATE DATABASE testtreederboards_1;
+    CREATE DATABASE testtreederboards_2;
     GRANT ALL PRIVILEGES ON DATABASE treederboards TO leaderboard;
     GRANT ALL PRIVILEGES ON DATABASE testtreederboards TO leaderboard;
+    GRANT ALL PRIVILEGES ON DATABASE testtreederboards_1 TO leaderboard;
+    GRANT ALL PRIVILEGES ON DATABASE testtreederboards_2 TO leaderboard;
 EOSQL
 psql -d treederboards -c 'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"'
 psql -d testtreederboards -c 'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"'
+psql -d testtreederboards_1 -c 'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"'
+psql -d testtreederboards_2 -c 'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"'
@@ -5,4 +5,10 @@ sleep 10;
 # Run migrations
 cd app
 alembic upgrade head
-cd ..
\ No newline at end of file
+# Run migrations on every extra shard
+for url in ${DATABASE_SHARDS//,/ }; do
+    DATABASE_URL=$url alembic upgrade head
+done
+cd ..
+# Copy users and apps onto newly added shards before they take traffic
+python -m app.database.shards sync